@@ -1,29 +1,135 @@
 
 
+class PipeList(list):
+    """
+    List of pipeline steps, which lets the owner pipeline know when it is changed in place
+    """
+
+    def __init__(self, steps=(), owner=None):
+        super().__init__(steps)
+        self.owner = owner
+
+    def __reduce__(self):
+        # Copies are built from the items, without notifying the owner being copied
+        return self.__class__, (list(self),), self.__dict__
+
+    def _changed(self):
+        if self.owner is not None:
+            self.owner._compile_pipe()
+
+    def __setitem__(self, index, value):
+        super().__setitem__(index, value)
+        self._changed()
+
+    def __delitem__(self, index):
+        super().__delitem__(index)
+        self._changed()
+
+    def __iadd__(self, other):
+        super().__iadd__(other)
+        self._changed()
+        return self
+
+    def __imul__(self, n):
+        super().__imul__(n)
+        self._changed()
+        return self
+
+    def append(self, step):
+        super().append(step)
+        self._changed()
+
+    def extend(self, steps):
+        super().extend(steps)
+        self._changed()
+
+    def insert(self, index, step):
+        super().insert(index, step)
+        self._changed()
+
+    def pop(self, index=-1):
+        step = super().pop(index)
+        self._changed()
+        return step
+
+    def remove(self, step):
+        super().remove(step)
+        self._changed()
+
+    def clear(self):
+        super().clear()
+        self._changed()
+
+    def sort(self, *args, **kwargs):
+        super().sort(*args, **kwargs)
+        self._changed()
+
+    def reverse(self):
+        super().reverse()
+        self._changed()
+
+
 class Pipeline:
     """Base class for pipelines"""
     def __init__(self):
         self.pipe = []
 
+    @property
+    def pipe(self):
+        """
+        List of (name, stage) steps.
+        Bound stage methods are collected again whenever the list is assigned or changed in place.
+        Steps themselves are not watched, replace a step instead of changing it in place
+        """
+        return self._pipe
+
+    @pipe.setter
+    def pipe(self, pipe):
+        self._pipe = PipeList(pipe, owner=self)
+        self._compile_pipe()
+
+    def _compile_pipe(self):
+        self._fits = [step[1].fit for step in self._pipe]
+
+        # Adjacent stages able to do their work together are run as one stage
+        stages = []
+        for _, stage in self._pipe:
+            fused = stages[-1].fuse(stage) if stages else None
+            if fused is None:
+                stages.append(stage)
+            else:
+                stages[-1] = fused
+
+        self._transforms = [stage.transform for stage in stages]
+        self._transforms_batch = [stage.transform_batch for stage in stages]
+
     def fit(self, X, Y=None):
         """
         Method to prepare or preprocess data and/or pipeline parameters,
         takes the training data as arguments, which can be one array X,
         or two arrays X and Y (for example, in the case of supervised learning).
         """
-        for i in range(len(self.pipe)):
-            self.pipe[i].fit(X, Y)
+        for f in self._fits:
+            f(X, Y)
         return self
 
     def transform(self, X):
         """
         Implements filtering or modifying the data X
         """
-        for i in range(len(self.pipe)):
-            step = self.pipe[i]
-            X = step[1].transform(X)
+        for f in self._transforms:
+            X = f(X)
         return X
 
+    def transform_batch(self, Xs):
+        """
+        Same as transform, but for a list of inputs.
+        Every stage gets the whole list, so stages able to process it at once (e.g. with spaCy nlp.pipe) can do so
+        """
+        for f in self._transforms_batch:
+            Xs = f(Xs)
+        return Xs
+
     def init_training(self):
         pass
 
@@ -35,3 +141,12 @@ class PipelineStage:
 
     def transform(self, X):
         return X
+
+    def transform_batch(self, Xs):
+        return [self.transform(X) for X in Xs]
+
+    def fuse(self, next_stage):
+        """
+        Return a stage doing the same as this stage followed by next_stage, or None if they can't be fused
+        """
+        return None
@@ -4,6 +4,7 @@ import copy
 import gzip
 import pickle
 import string
+from collections import Counter, defaultdict
 from typing import List, Iterable
 from pipeline import PipelineStage
 from contractions import CONTRACTIONS
@@ -11,6 +12,26 @@ from contractions import CONTRACTIONS
 
 UNK_LABEL = 'UNK'
 
+# One char tokens kept by OneChar
+_KEEP = frozenset(('i', 'a'))
+
+# Translation tables shared by all stages
+_PUNCT_STRIP = str.maketrans('', '', string.punctuation)
+_PUNCT_LIGHT = str.maketrans('', '', '!"#$%&()*+/:;<=>@[\\]^_`{|}~')
+_DIGIT_STRIP = str.maketrans('', '', string.digits)
+
+# Number of texts spaCy processes at once in transform_batch
+NLP_BATCH_SIZE = 64
+
+
+def select_pipes(nlp, unused_pipes):
+    """
+    Disable spaCy pipes not needed by a stage while parsing.
+    The model may be shared with other stages, so pipes are enabled back when done, and
+    pipes disabled by the owner of the model are left as they are
+    """
+    return nlp.select_pipes(disable=[name for name in unused_pipes if name in nlp.pipe_names])
+
 
 class CleanText(PipelineStage):
 
@@ -31,138 +52,246 @@ class CleanText(PipelineStage):
         return self.clean_txt(str(X))
 
 
-class LowerText(PipelineStage):
+class CharStage(PipelineStage):
+    """
+    Base class for stages which only lower case and/or translate characters.
+    Adjacent char stages are fused into one CharFusedStage, doing a single lower() and a single translate().
+    Subclasses overriding transform are not fused
+    """
+    _lower = False
+    _translate_table = {}
 
     def transform(self, X: str) -> str:
-        return X.lower()
+        if self._lower:
+            X = X.lower()
+        if self._translate_table:
+            X = X.translate(self._translate_table)
+        return X
 
+    def fuse(self, next_stage):
+        if not (isinstance(next_stage, CharStage) and
+                type(self).transform is CharStage.transform and
+                type(next_stage).transform is CharStage.transform):
+            return None
+        # The fused stage lowers first, then translates. Lowering after translation isn't the same
+        # (e.g. final sigma depends on the following chars), so such stages are kept apart
+        if next_stage._lower and self._translate_table:
+            return None
+        return CharFusedStage(compose_tables(self._translate_table, next_stage._translate_table),
+                              lower=self._lower or next_stage._lower)
 
-class CleanPunct(PipelineStage):
 
-    def transform(self, X: str) -> str:
-        return X.translate(str.maketrans('', '', string.punctuation))
+def compose_tables(first: dict, second: dict) -> dict:
+    """
+    Translation table doing the same as translating with the first table, then with the second one
+    """
+    table = {}
+    for key, value in first.items():
+        if value is None:
+            table[key] = None
+        elif isinstance(value, int):
+            table[key] = second.get(value, value)
+        else:
+            table[key] = value.translate(second)
+    for key, value in second.items():
+        table.setdefault(key, value)
+    return table
 
 
-class CleanPunctLight(PipelineStage):
+class CharFusedStage(CharStage):
 
-    def transform(self, X: str) -> str:
-        return X.translate(str.maketrans('', '', '!"#$%&()*+/:;<=>@[\\]^_`{|}~'))
+    def __init__(self, table, lower=False):
+        self._translate_table = table
+        self._lower = lower
 
 
-class CleanDigits(PipelineStage):
+class LowerText(CharStage):
+    _lower = True
+
+
+class CleanPunct(CharStage):
+    _translate_table = _PUNCT_STRIP
 
-    def transform(self, X: str) -> str:
-        return X.translate(str.maketrans('', '', string.digits))
 
+class CleanPunctLight(CharStage):
+    _translate_table = _PUNCT_LIGHT
 
-class GeneralizeDayNumber(PipelineStage):
+
+class CleanDigits(CharStage):
+    _translate_table = _DIGIT_STRIP
+
+
+def follows_rules(transform):
+    """
+    Mark transform of a TokenMapStage as doing just what the stage rules say, so the stage can be fused.
+    A subclass overriding transform without the mark is not fused
+    """
+    transform.follows_rules = True
+    return transform
+
+
+class TokenMapStage(PipelineStage):
+    """
+    Split text, replace tokens by label of the first matching rule, join tokens back.
+    Rules are (check, label, strip) triples, check gets the token without punctuation if strip is true.
+    Adjacent token map stages are fused into one, so the text is split and joined once.
+    Stages are not fused if rules of a stage match labels of the stage before it, as the result would differ
+    """
+
+    def __init__(self, rules=None):
+        self.rules = rules if rules is not None else []
+
+    @follows_rules
+    def transform(self, X: str) -> str:
+        out = []
+        for tok in X.split():
+            stripped = None
+            for check, label, strip in self.rules:
+                if strip:
+                    if stripped is None:
+                        stripped = tok.translate(_PUNCT_STRIP)
+                    matched = check(stripped)
+                else:
+                    matched = check(tok)
+                if matched:
+                    out.append(label)
+                    break
+            else:
+                out.append(tok)
+        return ' '.join(out)
+
+    def fuse(self, next_stage):
+        if not (getattr(next_stage, 'rules', None) is not None and
+                getattr(type(self).transform, 'follows_rules', False) and
+                getattr(type(next_stage).transform, 'follows_rules', False)):
+            return None
+        # Running stages one after another, the next stage gets labels of this one as tokens
+        for label in {label for _, label, _ in self.rules}:
+            stripped = label.translate(_PUNCT_STRIP)
+            if any(check(stripped if strip else label) for check, _, strip in next_stage.rules):
+                return None
+        return TokenMapStage(self.rules + next_stage.rules)
+
+
+class GeneralizeDayNumber(TokenMapStage):
     """
     Replace day number by label
     """
 
     def __init__(self):
         self._label = 'DAY_NUMBER'
+        super().__init__([(self.is_day, self._label, False)])
 
-        day_regex_list = [
-            '([1-31]|[0-2][0-9]|[3][0,1])',
-        ]
-        self.day_regex = re.compile('|'.join(day_regex_list))
+    @staticmethod
+    def is_day(token: str) -> bool:
+        # 1..31, optionally zero padded
+        return len(token) <= 2 and token.isascii() and token.isdigit() and 1 <= int(token) <= 31
 
+    @follows_rules
     def transform(self, X: str) -> str:
         tokens = []
         for token in X.split():
-            tokens.append(self._label if re.fullmatch(self.day_regex, token) else token)
+            # same as is_day, inlined
+            is_day = len(token) <= 2 and token.isascii() and token.isdigit() and 1 <= int(token) <= 31
+            tokens.append(self._label if is_day else token)
         return ' '.join(tokens)
 
 
-class GeneralizeYear(PipelineStage):
+class GeneralizeYear(TokenMapStage):
     """
     Replace year (determined in reasonable way) by label
     """
 
     def __init__(self):
         self._label = 'YEAR'
+        super().__init__([(self.is_year, self._label, False)])
 
-        year_regex_list = [
-            '([1-2][0-9]{3})',
-        ]
-        self.year_regex = re.compile('|'.join(year_regex_list))
+    @staticmethod
+    def is_year(token: str) -> bool:
+        # four digits, 1000..2999
+        return len(token) == 4 and token.isascii() and token.isdigit() and 1000 <= int(token) <= 2999
 
+    @follows_rules
     def transform(self, X: str) -> str:
         tokens = []
         for token in X.split():
-            tokens.append(self._label if re.fullmatch(self.year_regex, token) else token)
+            # same as is_year, inlined
+            is_year = len(token) == 4 and token.isascii() and token.isdigit() and 1000 <= int(token) <= 2999
+            tokens.append(self._label if is_year else token)
         return ' '.join(tokens)
 
-
-class GeneralizeTimeOfTheDay(PipelineStage):
+class GeneralizeTimeOfTheDay(TokenMapStage):
     """
     Replace time of the day by label
     """
 
     def __init__(self):
         self._label = 'TIME_OF_THE_DAY'
-        self.synonyms = ('afternoon', 'arvo', 'bedtime'
-                                              'day', 'daylight', 'daytime',
-                         'eve', 'evening', 'mealtime',
-                         'morning', 'night', 'nighttime',
-                         'tonight', 'lunchtime'
-                         )
-
+        self.synonyms = frozenset({'afternoon', 'arvo', 'bedtime',
+                                   'day', 'daylight', 'daytime',
+                                   'eve', 'evening', 'mealtime',
+                                   'morning', 'night', 'nighttime',
+                                   'tonight', 'lunchtime',
+                                   })
+        super().__init__([(self.synonyms.__contains__, self._label, True)])
+
+    @follows_rules
     def transform(self, X: str) -> str:
         return ' '.join([self._label
-                         if token.translate(str.maketrans('', '', string.punctuation)) in self.synonyms else token
+                         if token.translate(_PUNCT_STRIP) in self.synonyms else token
                          for token in X.split()
                          if token.strip()])
 
-
-class GeneralizeDayOfWeek(PipelineStage):
+class GeneralizeDayOfWeek(TokenMapStage):
     """
     Replace day of week by label
     """
 
     def __init__(self):
         self._label = 'DAY_OF_WEEK'
-        self.synonyms = ('monday', 'mon', 'mo',
-                         'tuesday', 'tue', 'tu',
-                         'wednesday', 'wed', 'we',
-                         'thursday', 'thu', 'th',
-                         'friday', 'fri', 'fr',
-                         'saturday', 'sat', 'sa',
-                         'sunday', 'sun', 'su',
-                         )
-
+        self.synonyms = frozenset({'monday', 'mon', 'mo',
+                                   'tuesday', 'tue', 'tu',
+                                   'wednesday', 'wed', 'we',
+                                   'thursday', 'thu', 'th',
+                                   'friday', 'fri', 'fr',
+                                   'saturday', 'sat', 'sa',
+                                   'sunday', 'sun', 'su',
+                                   })
+        super().__init__([(self.synonyms.__contains__, self._label, True)])
+
+    @follows_rules
     def transform(self, X: str) -> str:
         return ' '.join([self._label
-                         if token.translate(str.maketrans('', '', string.punctuation)) in self.synonyms else token
+                         if token.translate(_PUNCT_STRIP) in self.synonyms else token
                          for token in X.split()
                          if token.strip()])
 
-
-class GeneralizeMonth(PipelineStage):
+class GeneralizeMonth(TokenMapStage):
     """
     Replace month by label
     """
 
     def __init__(self):
         self._label = 'MONTH'
-        self.synonyms = ('january', 'jan',
-                         'february', 'feb',
-                         'march', 'mar',
-                         'april', 'apr',
-                         'may',
-                         'june', 'jun',
-                         'july', 'jul',
-                         'august', 'aug',
-                         'september', 'sep', 'sept',
-                         'october', 'oct',
-                         'november', 'nov',
-                         'december', 'dec',
-                         )
-
+        self.synonyms = frozenset({'january', 'jan',
+                                   'february', 'feb',
+                                   'march', 'mar',
+                                   'april', 'apr',
+                                   'may',
+                                   'june', 'jun',
+                                   'july', 'jul',
+                                   'august', 'aug',
+                                   'september', 'sep', 'sept',
+                                   'october', 'oct',
+                                   'november', 'nov',
+                                   'december', 'dec',
+                                   })
+        super().__init__([(self.synonyms.__contains__, self._label, True)])
+
+    @follows_rules
     def transform(self, X: str) -> str:
         return ' '.join([self._label
-                         if token.translate(str.maketrans('', '', string.punctuation)) in self.synonyms else token
+                         if token.translate(_PUNCT_STRIP) in self.synonyms else token
                          for token in X.split()
                          if token.strip()])
 
@@ -171,24 +300,78 @@ class GeneralizeEnts(PipelineStage):
     """
     Replace words by recognized named entities
     PERSON, NORP, FACILITY, ORG, GPE, LOC, PRODUCT, EVENT, WORK_OF_ART, LANGUAGE, LAW, DATE, TIME, PERCENT, MONEY, QUANTITY, ORDINAL, CARDINAL
+
+    Lazy mode skips spaCy NER and only replaces entities recognized by cheap regular expressions
+    (by default DATE, MONEY and CARDINAL), which is enough for ingesting a corpus.
+    Full NER is used when the stage is not lazy, use it when recall matters.
     """
 
-    def __init__(self, nlp_model=None, ignore_ents=None):
+    # Only NER is needed
+    unused_pipes = ('tagger', 'parser', 'attribute_ruler', 'lemmatizer')
+
+    # label: regex, tried in this order
+    FAST_PATTERNS = {
+        'DATE': r'\b\d{4}-\d{2}-\d{2}\b|\b\d{1,2}/\d{1,2}/\d{2,4}\b',
+        'MONEY': r'\$\d[\d,]*(?:\.\d+)?',
+        'CARDINAL': r'\b\d[\d,]*(?:\.\d+)?\b',
+    }
+
+    def __init__(self, nlp_model=None, ignore_ents=None, lazy=None, fast_patterns=None):
+        """
+        lazy: use fast regex matching instead of spaCy NER, by default lazy if there is no nlp_model
+        fast_patterns: {label: regex} used in lazy mode, FAST_PATTERNS by default
+        """
         self.nlp = nlp_model
-        self.ignore_ents = ignore_ents if ignore_ents is not None else []
+        self.ignore_ents = frozenset(ignore_ents) if ignore_ents is not None else frozenset()
+        self.lazy = nlp_model is None if lazy is None else lazy
+
+        fast_patterns = fast_patterns if fast_patterns is not None else self.FAST_PATTERNS
+        # Labels may be not valid group names, so groups are named _ent0, _ent1, ... and mapped back to labels
+        self.fast_labels = {f'_ent{i}': label for i, label in enumerate(fast_patterns)}
+        self.fast_regex = re.compile('|'.join(f'(?P<_ent{i}>{regex})'
+                                              for i, regex in enumerate(fast_patterns.values())))
+
+    @classmethod
+    def ingest_entity_extractor(cls, ignore_ents=None, fast_patterns=None):
+        return cls(ignore_ents=ignore_ents, lazy=True, fast_patterns=fast_patterns)
+
+    @classmethod
+    def query_entity_extractor(cls, nlp_model, ignore_ents=None):
+        return cls(nlp_model=nlp_model, ignore_ents=ignore_ents, lazy=False)
 
     def label(self, label_):
         return label_
 
     def transform(self, X: str) -> str:
-        doc = self.nlp(X)
-        for ent in reversed(doc.ents):
+        if self.lazy:
+            return self.fast_replace_ents(X)
+        with select_pipes(self.nlp, self.unused_pipes):
+            return self.replace_ents(X, self.nlp(X))
+
+    def transform_batch(self, Xs: List[str]) -> List[str]:
+        if self.lazy:
+            return [self.fast_replace_ents(X) for X in Xs]
+        with select_pipes(self.nlp, self.unused_pipes):
+            return [self.replace_ents(X, doc)
+                    for doc, X in zip(self.nlp.pipe(Xs, batch_size=NLP_BATCH_SIZE), Xs)]
+
+    def fast_replace_ents(self, X: str) -> str:
+        def replace(match):
+            label = self.label(self.fast_labels[match.lastgroup])
+            return match.group(0) if label in self.ignore_ents else label
+
+        return self.fast_regex.sub(replace, X)
+
+    def replace_ents(self, X: str, doc) -> str:
+        # doc.ents are sorted and don't overlap, so build the result in one pass
+        pieces, cursor = [], 0
+        for ent in doc.ents:
+            pieces.append(X[cursor:ent.start_char])
             label = self.label(ent.label_)
-            if label in self.ignore_ents:
-                X = X[:ent.start_char] + ent.text + X[ent.end_char:]
-            else:
-                X = X[:ent.start_char] + label + X[ent.end_char:]
-        return X
+            pieces.append(ent.text if label in self.ignore_ents else label)
+            cursor = ent.end_char
+        pieces.append(X[cursor:])
+        return ''.join(pieces)
 
 
 class Decontract(PipelineStage):
@@ -196,14 +379,14 @@ class Decontract(PipelineStage):
     Replace contractions with their full versions
     """
 
+    def __init__(self):
+        # Whole whitespace-delimited tokens only, longer contractions first
+        contractions = sorted(CONTRACTIONS, key=len, reverse=True)
+        self.contraction_regex = re.compile(r'(?<!\S)(' + '|'.join(map(re.escape, contractions)) + r')(?!\S)')
+
     def transform(self, X: str) -> str:
         X = X.replace("’", "'")
-        for token in X.split():
-            decontraction = CONTRACTIONS.get(token)
-            if decontraction:
-                X = X.replace(token, decontraction)
-
-        return X
+        return self.contraction_regex.sub(lambda m: CONTRACTIONS[m.group(0)], X)
 
 
 class SkipPastTenses(PipelineStage):
@@ -214,33 +397,56 @@ class SkipPastTenses(PipelineStage):
     If not, we iterate dependency children and check if there is an auxiliary verb having VBD form
     """
 
+    # Tags and dependencies are needed, entities are not
+    unused_pipes = ('ner', 'lemmatizer')
+
     def __init__(self, nlp_model):
         self.nlp = nlp_model
 
+        # Compare integer ids of tags and labels instead of their strings
+        strings = self.nlp.vocab.strings
+        self._VBD = strings['VBD']
+        self._VBP = strings['VBP']
+        self._AUX = strings['aux']
+        self._ROOT = strings['ROOT']
+        self._VERB = strings['VERB']
+
     def detect_past_tense(self, sentence):
-        sents = list(self.nlp(sentence).sents)
+        with select_pipes(self.nlp, self.unused_pipes):
+            return self.detect_past_tense_doc(self.nlp(sentence))
+
+    def detect_past_tense_doc(self, doc):
+        sents = list(doc.sents)
 
         if not sents:
             return False
 
-        sent_token = sents[-1]  # analyze last sentence only
-        if sent_token.root.dep_ == 'ROOT':
-            if (sent_token.root.tag_ == "VBD" or
-                    (any(w.dep_ == "aux" and w.tag_ == "VBD" for w in sent_token.root.children) and
-                     len([x for x in sent_token.root.children]) > 1)):
+        root = sents[-1].root  # analyze last sentence only
+        if root.dep == self._ROOT:
+            children = list(root.children)
+            vbd = self._VBD
+            aux = self._AUX
+            if (root.tag == vbd or
+                    (len(children) > 1 and any(w.dep == aux and w.tag == vbd for w in children))):
                 # It may be a complex sentence, let's check the tenses of constitutes
                 is_past_tense = True
-                for child in sent_token.root.children:
-                    if child.pos_ == 'VERB':
-                        is_past_tense = not child.tag_ == 'VBP'
+                for child in children:
+                    if child.pos == self._VERB:
+                        is_past_tense = not child.tag == self._VBP
                 return is_past_tense
 
         return False
 
     def transform(self, X: str) -> str:
-        sentence = X if type(X) == str else ' '.join(X)
+        sentence = X if isinstance(X, str) else ' '.join(X)
         return '' if self.detect_past_tense(sentence) else X
 
+    def transform_batch(self, Xs: List) -> List:
+        sentences = [X if isinstance(X, str) else ' '.join(X) for X in Xs]
+        with select_pipes(self.nlp, self.unused_pipes):
+            docs = self.nlp.pipe(sentences, batch_size=NLP_BATCH_SIZE)
+            return ['' if self.detect_past_tense_doc(doc) else X for doc, X in zip(docs, Xs)]
+
 
 class TokenizeSplit(PipelineStage):
 
@@ -255,8 +461,9 @@ class CountOfTokens(PipelineStage):
     def __init__(self, n):
         self.n = n
 
-    def transform(self, X: str) -> List[str]:
-        doc = X.split()
+    def transform(self, X: str) -> str:
+        # No need to split further than n + 1 tokens to know there are more than n
+        doc = X.split(maxsplit=self.n)
         return '' if len(doc) <= self.n else X
 
 
@@ -275,9 +482,9 @@ class Detokenize(PipelineStage):
 class StopWords(PipelineStage):
 
     def __init__(self):
-        self.stop_words = (
+        self.stop_words = frozenset({
             'op',
-        )
+        })
 
     def transform(self, X: List[str]) -> List[str]:
         return [token if token not in self.stop_words else UNK_LABEL for token in X]
@@ -286,7 +493,7 @@ class StopWords(PipelineStage):
 class OneChar(PipelineStage):
 
     def transform(self, X: List[str]) -> List[str]:
-        return [token if len(token) > 1 or token in ('i', 'a') else UNK_LABEL for token in X]
+        return [token if len(token) > 1 or token in _KEEP else UNK_LABEL for token in X]
 
 
 class OmittedPrepositions(PipelineStage):
@@ -323,12 +530,11 @@ class OmittedPrepositions(PipelineStage):
         self.storage_path = storage_path
 
         self.nlp = copy.deepcopy(nlp_model)
-        self.nlp.disable_pipes('ner', 'lemmatizer')
+        # Only the POS tag of a single token is needed, parsing is not
+        self.nlp.disable_pipes('ner', 'lemmatizer', 'parser')
 
         self.prepositions = ('on', 'at', 'in')
-
-        regex_list = ['(.* +on(( +)|$).*)', '(.* +at(( +)|$).*)', '(.* +in(( +)|$).*)']
-        self.preposition_regex = re.compile('|'.join(regex_list))
+        self._prep_set = frozenset(self.prepositions)
 
         # Stat dictionary
         # { 'token': (n1, n2, n3, n4), ...}
@@ -356,7 +562,7 @@ class OmittedPrepositions(PipelineStage):
             file = os.path.join(self.storage_path, self.file_name)
             with gzip.open(file, 'wb') as f:
                 tmp = {
-                    'stat': self.stat,
+                    'stat': {token: tuple(cnts) for token, cnts in self.stat.items()},
                     'threshold': self.threshold,
                 }
                 pickle.dump(tmp, f, pickle.HIGHEST_PROTOCOL)
@@ -374,33 +580,23 @@ class OmittedPrepositions(PipelineStage):
                 # self.threshold = tmp['threshold']
 
     def fit(self, X: Iterable[str], Y=None):
-        self.stat = {}
+        stat = defaultdict(lambda: [0, 0, 0, 0])
+        totals = Counter()
         for txt in X:
-            if not re.fullmatch(self.preposition_regex, str(txt)):
+            tokens = str(txt).split()
+            totals.update(tokens)
+            if not self._prep_set.intersection(tokens):
                 continue
 
-            tokens = txt.split()
-            for i, t in enumerate(tokens[1:]):
+            for prev_token, t in zip(tokens, tokens[1:]):
                 if t not in self.prepositions:
                     continue
-                prev_token = tokens[i]
-                prep_indx = self.prepositions.index(t) + 1
-                if prev_token in self.stat.keys():
-                    val = list(self.stat[prev_token])
-                    val[prep_indx] += 1
-                    self.stat.update({prev_token: tuple(val)})
-                else:
-                    val = [0, 0, 0, 0]
-                    val[prep_indx] = 1
-                    self.stat[prev_token] = tuple(val)
+                stat[prev_token][self.prepositions.index(t) + 1] += 1
 
-        keys = self.stat.keys()
-        for txt in X:
-            for token in txt.split():
-                if token in keys:
-                    val = list(self.stat[token])
-                    val[0] += 1
-                    self.stat[token] = tuple(val)
+        # Counts are mutable lists while fitting, save() stores them as tuples
+        self.stat = dict(stat)
+        for token, cnts in self.stat.items():
+            cnts[0] = totals[token]
 
         return self
 
@@ -409,16 +605,24 @@ class OmittedPrepositions(PipelineStage):
         if not X:
             return X
 
-        doc = self.nlp(X[-1])
+        return self.append_preposition(X, self.nlp(X[-1]))
+
+    def transform_batch(self, Xs: List[List[str]]) -> List[List[str]]:
+        docs = self.nlp.pipe((X[-1] for X in Xs if X), batch_size=NLP_BATCH_SIZE)
+        return [self.append_preposition(X, next(docs)) if X else X for X in Xs]
+
+    def append_preposition(self, X: List[str], doc) -> List[str]:
         if doc:
             last_tok = doc[-1]
             if last_tok.pos_ == 'VERB':
                 cnts = self.stat.get(last_tok.text, None)
                 if cnts:
-                    max_index = cnts[1:].index(max(cnts[1:])) + 1
+                    threshold = self.threshold
+                    # the most frequent preposition, the first one on ties
+                    max_index = max(range(1, 4), key=cnts.__getitem__)
                     cnt_with_prep = cnts[max_index]
                     cnt_total = cnts[0]
-                    factor = cnt_total / cnt_with_prep if cnt_with_prep else self.threshold
-                    if factor <= self.threshold:
+                    factor = cnt_total / cnt_with_prep if cnt_with_prep else threshold
+                    if factor <= threshold:
                         X.append(self.prepositions[max_index - 1])
         return X